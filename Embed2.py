@@ -1,24 +1,32 @@
-from transformers import T5Tokenizer
+import os
+from datasets import Dataset
+from transformers import T5TokenizerFast
 import torch
 
 print("schema_matching|Loading T5 tokenizer, this will take a while...")
-tokenizer = T5Tokenizer.from_pretrained('t5-base')
+tokenizer = T5TokenizerFast.from_pretrained('t5-base')
 print("schema_matching|Done loading T5 tokenizer")
 
+def tokenize_batch(batch):
+    """Tokenize a batch of SQL statements and lineages."""
+    input_texts = ["Generate SQL lineage: " + sql for sql in batch["sql"]]
+    # Left unpadded; DataCollatorForSeq2Seq(pad_to_multiple_of=8) pads each training batch to its own longest example
+    input_encodings = tokenizer(input_texts, truncation=True, max_length=1024)
+    
+    target_encodings = tokenizer(batch["lineage"], truncation=True, max_length=512)
+    
+    return {
+        "input_ids": input_encodings["input_ids"],
+        "attention_mask": input_encodings["attention_mask"],
+        "labels": target_encodings["input_ids"]
+    }
+
 def prepare_data(sql_statements, lineages):
     """Prepare data by tokenizing SQL statements and lineages."""
-    dataset = []
-    for sql, lineage in zip(sql_statements, lineages):
-        input_text = "Generate SQL lineage: " + sql
-        input_encodings = tokenizer(input_text, padding="max_length", truncation=True, max_length=1024, return_tensors="pt")
-        
-        target_encodings = tokenizer(lineage, padding="max_length", truncation=True, max_length=512, return_tensors="pt")
-        
-        dataset.append({
-            "input_ids": input_encodings["input_ids"].squeeze(),
-            "attention_mask": input_encodings["attention_mask"].squeeze(),
-            "labels": target_encodings["input_ids"].squeeze()
-        })
+    dataset = Dataset.from_dict({"sql": list(sql_statements), "lineage": list(lineages)})
+    num_proc = max(1, min(os.cpu_count() or 1, len(dataset)))
+    dataset = dataset.map(tokenize_batch, batched=True, batch_size=1000, num_proc=num_proc, remove_columns=["sql", "lineage"])
+    dataset.set_format(type="torch")
     
     return dataset
 
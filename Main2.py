@@ -1,10 +1,3 @@
-import os
-from embed import prepare_data, tokenizer
-from train import optimize_hyperparameters, cross_validation
-import json
-import datetime
-from transformers import DataCollatorForSeq2Seq
-
 # Complex evaluation data with CTEs
 eval_data = [
     {
@@ -193,10 +186,12 @@ ORDER BY ch.level, ch.total_sales DESC;
 ]
 
 import os
-from embed import prepare_data, tokenizer
-from train import optimize_hyperparameters, cross_validation
+from embed import prepare_data, tokenizer, PROMPT, MAX_LENGTH, PREPARE_DATA_VERSION
+from Train2 import optimize_hyperparameters, cross_validation
 import json
 import datetime
+import hashlib
+from datasets import Dataset, load_from_disk
 from transformers import DataCollatorForSeq2Seq
 
 # Complex evaluation data with CTEs
@@ -216,9 +211,37 @@ def process_subfolder(subfolder_path):
         return sql_statement, lineage
     return None, None
 
+def dataset_cache_key(examples):
+    """Hash of the examples and everything prepare_data tokenizes them with."""
+    settings = [tokenizer.name_or_path, PROMPT, MAX_LENGTH, PREPARE_DATA_VERSION]
+    return hashlib.sha1(json.dumps([examples, settings]).encode()).hexdigest()
+
+def load_eval_dataset(cache_dir="cache"):
+    """Tokenize eval_data, reusing the copy cached on disk while eval_data is unchanged."""
+    cache_path = os.path.join(cache_dir, f"eval-{dataset_cache_key(eval_data)}")
+    if os.path.exists(cache_path):
+        return load_from_disk(cache_path)
+
+    eval_dataset = Dataset.from_list(prepare_data([item['sql'] for item in eval_data], [item['lineage'] for item in eval_data]))
+    eval_dataset.save_to_disk(cache_path)
+    return eval_dataset
+
+def load_train_dataset(examples, cache_dir="cache"):
+    """Tokenize all (sql, lineage) examples in one batch, save them as an Arrow dataset on disk and
+    memory-map it back, so every fold and trial selects from the same table instead of copying Python lists."""
+    cache_path = os.path.join(cache_dir, f"train-{dataset_cache_key(examples)}")
+    if not os.path.exists(cache_path):
+        tokenized = prepare_data([sql for sql, _ in examples], [lineage for _, lineage in examples])
+        train_dataset = Dataset.from_list(tokenized)
+        # Stored for Trainer's group_by_length sampler so it need not re-measure every example
+        train_dataset = train_dataset.add_column("length", [len(item["input_ids"]) for item in tokenized])
+        train_dataset.save_to_disk(cache_path)
+    return load_from_disk(cache_path)
+
 def main():
     input_folder = "Input"  # Change this to your input folder path
-    all_datasets = []
+    examples = []
+    seen = set()
     for subfolder in os.listdir(input_folder):
         subfolder_path = os.path.join(input_folder, subfolder)
         if os.path.isdir(subfolder_path):
@@ -229,35 +252,42 @@ def main():
                 print(f"Skipping subfolder {subfolder}: Missing sql.txt or output.txt")
                 continue
             
-            print("Preparing data...")
-            dataset = prepare_data([sql_statement], [lineage])
-            all_datasets.extend(dataset)
+            if (sql_statement, lineage) in seen:
+                print(f"Skipping subfolder {subfolder}: Duplicate of an earlier example")
+                continue
+            seen.add((sql_statement, lineage))
+            
+            examples.append([sql_statement, lineage])
             print("\nExample of input from this subfolder:")
             print("SQL statement:")
             print(sql_statement)
             print("\nLineage:")
             print(lineage)
-            print("\nTokenized input:")
-            print(dataset[0])
             print("=" * 50)
 
-    if not all_datasets:
+    if not examples:
         print("No valid data found in any subfolder. Exiting.")
         return
 
+    # Tokenize every subfolder's example in one batched call, or reuse the cached result
+    print("Preparing data...")
+    train_dataset = load_train_dataset(examples)
+    print("\nTokenized input of the first example:")
+    print(train_dataset[0])
+
     # Prepare evaluation dataset
-    eval_dataset = prepare_data([item['sql'] for item in eval_data], [item['lineage'] for item in eval_data])
+    eval_dataset = load_eval_dataset()
 
     # Create model save directory
     model_save_path = f"model/{datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S')}"
     os.makedirs(model_save_path, exist_ok=True)
     
     # Create data collator
-    data_collator = DataCollatorForSeq2Seq(tokenizer=tokenizer, model="t5-base")
+    data_collator = DataCollatorForSeq2Seq(tokenizer=tokenizer, model="t5-base", pad_to_multiple_of=8)
     
     # Optimize hyperparameters
     print("Optimizing hyperparameters...")
-    best_params = optimize_hyperparameters(all_datasets, eval_dataset, model_save_path, data_collator)
+    best_params = optimize_hyperparameters(train_dataset, eval_dataset, model_save_path, data_collator)
     print("Best parameters:", best_params)
     
     # Save best parameters
@@ -266,7 +296,7 @@ def main():
     
     # Final training with best parameters
     print("Training final model with best parameters...")
-    rouge1, rouge2, rougeL = cross_validation(all_datasets, eval_dataset, best_params, model_save_path, data_collator)
+    rouge1, rouge2, rougeL = cross_validation(train_dataset, eval_dataset, best_params, model_save_path, data_collator)
     
     print(f"Final results - ROUGE-1: {rouge1:.3f}, ROUGE-2: {rouge2:.3f}, ROUGE-L: {rougeL:.3f}")
     
@@ -1,61 +1,140 @@
 import os
 import argparse
-from transformers import T5ForConditionalGeneration, T5Tokenizer
+from transformers import T5ForConditionalGeneration, T5TokenizerFast
 import json
 import torch
 from collections import Counter
+from itertools import islice
+
+# Let any remaining float32 matmuls run on TF32 Tensor Cores
+torch.set_float32_matmul_precision('high')
+
+DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+TOKENIZER = T5TokenizerFast.from_pretrained('t5-base')
 
 def load_models(model_path):
     """Load all trained models."""
     models = []
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     for folder in os.listdir(model_path):
         if os.path.isdir(os.path.join(model_path, folder)) and folder.isdigit():
             model = T5ForConditionalGeneration.from_pretrained(os.path.join(model_path, folder))
-            model.to(device)
+            # Reuse cached decoder keys/values between steps even if training switched the cache off
+            model.config.use_cache = True
+            model.to(DEVICE)
+            if DEVICE.type == "cuda" and torch.cuda.is_bf16_supported():
+                # T5 activations overflow in float16, so GPUs without bfloat16 keep float32
+                model.to(torch.bfloat16)
             model.eval()
             models.append(model)
     if not models:
         raise ValueError(f"No models found in {model_path}")
     return models
 
-def predict_lineage(sql, models, tokenizer):
+def to_device(tensor):
+    """Copy a CPU tensor to DEVICE, letting the copy overlap with GPU work."""
+    if DEVICE.type == "cuda":
+        return tensor.pin_memory().to(DEVICE, non_blocking=True)
+    return tensor
+
+def majority_is_decided(votes, remaining):
+    """Return True when `remaining` more votes cannot change the most common prediction."""
+    top = votes.most_common(2)
+    runner_up = top[1][1] if len(top) > 1 else 0
+    return top[0][1] > runner_up + remaining
+
+def predict_lineage(sql, models, tokenizer=TOKENIZER):
     """Predict lineage for a given SQL statement using ensemble of models."""
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     inputs = tokenizer("Generate SQL lineage: " + sql, return_tensors="pt", max_length=1024, padding="max_length", truncation=True)
-    input_ids = inputs.input_ids.to(device)
-    attention_mask = inputs.attention_mask.to(device)
+    input_ids = to_device(inputs.input_ids)
+    attention_mask = to_device(inputs.attention_mask)
     
-    predictions = []
-    with torch.no_grad():
-        for model in models:
-            output = model.generate(input_ids, attention_mask=attention_mask, max_length=512, num_return_sequences=1, num_beams=4)
-            prediction = tokenizer.decode(output[0], skip_special_tokens=True)
-            predictions.append(prediction)
+    votes = Counter()
+    with torch.inference_mode():
+        for done, model in enumerate(models, start=1):
+            # Inputs here are always padded to 1024 tokens, so a static KV cache keeps every call the same
+            # shape and generate() can replay compiled decode steps as CUDA graphs. Batched calls vary in
+            # shape and keep the default dynamic cache.
+            static_cache = DEVICE.type == "cuda" and getattr(model, "_supports_static_cache", False)
+            output = model.generate(input_ids, attention_mask=attention_mask, max_length=512, num_return_sequences=1, num_beams=4, use_cache=True, early_stopping=True,
+                                    cache_implementation="static" if static_cache else None)
+            votes[tokenizer.decode(output[0], skip_special_tokens=True)] += 1
+            # Skip the remaining models once they can no longer change the result
+            if majority_is_decided(votes, len(models) - done):
+                break
     
     # Use the most common prediction as the final result
-    return Counter(predictions).most_common(1)[0][0]
+    return votes.most_common(1)[0][0]
+
+def token_budget_batches(order, input_ids, max_tokens_per_batch):
+    """Split length-sorted indices into batches whose padded size fits max_tokens_per_batch."""
+    batch = []
+    for i in order:
+        # Inputs are sorted by length, so the newest one sets the batch's padded length
+        padded_length = -(-len(input_ids[i]) // 8) * 8
+        if batch and (len(batch) + 1) * padded_length > max_tokens_per_batch:
+            yield batch
+            batch = []
+        batch.append(i)
+    if batch:
+        yield batch
+
+def predict_lineage_batch(sqls, models, tokenizer=TOKENIZER, max_tokens_per_batch=8192):
+    """Predict lineage for a list of SQL statements using ensemble of models."""
+    encodings = tokenizer(["Generate SQL lineage: " + sql for sql in sqls], max_length=1024, truncation=True)
+    # Batch statements of similar token length together so little padding is generated
+    order = sorted(range(len(sqls)), key=lambda i: len(encodings["input_ids"][i]))
+    predictions = [None] * len(sqls)
+    
+    with torch.inference_mode():
+        for batch_indices in token_budget_batches(order, encodings["input_ids"], max_tokens_per_batch):
+            inputs = tokenizer.pad({
+                "input_ids": [encodings["input_ids"][i] for i in batch_indices],
+                "attention_mask": [encodings["attention_mask"][i] for i in batch_indices]
+            }, padding=True, pad_to_multiple_of=8, return_tensors="pt")
+            input_ids = to_device(inputs.input_ids)
+            attention_mask = to_device(inputs.attention_mask)
+            
+            batch_votes = [Counter() for _ in batch_indices]
+            for done, model in enumerate(models, start=1):
+                output = model.generate(input_ids, attention_mask=attention_mask, max_length=512, num_return_sequences=1, num_beams=4, use_cache=True, early_stopping=True)
+                for votes, prediction in zip(batch_votes, tokenizer.batch_decode(output, skip_special_tokens=True)):
+                    votes[prediction] += 1
+                if all(majority_is_decided(votes, len(models) - done) for votes in batch_votes):
+                    break
+            
+            # Use the most common prediction of each statement as its final result
+            for i, votes in zip(batch_indices, batch_votes):
+                predictions[i] = votes.most_common(1)[0][0]
+    
+    return predictions
 
 def load_sql_from_file(file_path):
     with open(file_path, 'r') as f:
         return f.read().strip()
 
+def read_lines(file_path):
+    """Yield the lines of a file one at a time without the trailing newline."""
+    with open(file_path, 'r') as f:
+        for line in f:
+            yield line.rstrip('\n')
+
 def evaluate_model(model_path, test_sql_file, test_lineage_file):
     models = load_models(model_path)
-    tokenizer = T5Tokenizer.from_pretrained('t5-base')
     
-    with open(test_sql_file, 'r') as f:
-        test_sql_statements = f.readlines()
-    with open(test_lineage_file, 'r') as f:
-        test_lineages = f.readlines()
-
     correct_predictions = 0
-    total_predictions = len(test_sql_statements)
+    total_predictions = 0
 
-    for sql, true_lineage in zip(test_sql_statements, test_lineages):
-        predicted_lineage = predict_lineage(sql, models, tokenizer)
-        if predicted_lineage.strip() == true_lineage.strip():
-            correct_predictions += 1
+    test_pairs = zip(read_lines(test_sql_file), read_lines(test_lineage_file))
+    while True:
+        chunk = list(islice(test_pairs, 1024))
+        if not chunk:
+            break
+        test_sql_statements = [sql for sql, _ in chunk]
+        predicted_lineages = predict_lineage_batch(test_sql_statements, models)
+        for predicted_lineage, (_, true_lineage) in zip(predicted_lineages, chunk):
+            if predicted_lineage.strip() == true_lineage.strip():
+                correct_predictions += 1
+        total_predictions += len(chunk)
 
     accuracy = correct_predictions / total_predictions
     print(f"Model Accuracy: {accuracy:.4f}")
@@ -78,7 +157,6 @@ if __name__ == "__main__":
 
     print(f"Loading model from: {model_path}")
     models = load_models(model_path)
-    tokenizer = T5Tokenizer.from_pretrained('t5-base')
 
     # Load best parameters
     with open(f"{model_path}/best_params.json", 'r') as f:
@@ -124,7 +202,7 @@ if __name__ == "__main__":
             ORDER BY cte3.total_spent DESC;
             """
 
-        predicted_lineage = predict_lineage(test_sql, models, tokenizer)
+        predicted_lineage = predict_lineage(test_sql, models)
         
         print(f"SQL:\n{test_sql}")
         print(f"\nPredicted Lineage:\n{predicted_lineage}")
@@ -1,228 +1,350 @@
-import sqlparse
-from sqlparse.sql import IdentifierList, Identifier, Function, Where, Comparison, Parenthesis
-from typing import List, Dict, Set, Tuple
+import functools
+import sys
+import multiprocessing
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import sqlglot
+from sqlglot import exp
+from sqlglot.dialects.dialect import Dialect
+from typing import List, Dict, Set, Tuple, Optional, Iterable, DefaultDict, TextIO, Union, Collection
+
+# Forked workers inherit the already-imported parser modules
+_MP_CONTEXT = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+
+@functools.lru_cache(maxsize=None)
+def _get_dialect(dialect: Optional[str]) -> Dialect:
+    return Dialect.get_or_raise(dialect)
+
+# One pool per worker count, started on the first parallel WITH/UNION and kept for the rest of the process
+@functools.lru_cache(maxsize=None)
+def _get_pool(workers: int) -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(max_workers=workers, mp_context=_MP_CONTEXT)
+
+# (table, column) pair; a column that could not be tied to a table has table ''
+ColumnRef = Tuple[str, str]
+# Most columns have a few sources, kept in a list; past this many they move to a set
+_SMALL_SOURCES = 8
+
+# Subtrees are sent as SQL text, so a task never pickles the rest of the statement's AST
+def _trace_subtree(sql: str, target_table: str, dialect: Optional[str], table_aliases: Dict[str, str]) -> Tuple[Dict[ColumnRef, Collection[ColumnRef]], Dict[str, exp.Expression]]:
+    tracer = SQLLineageTracer(dialect)
+    tracer.table_aliases = table_aliases
+    tracer._process_node(_get_dialect(dialect).parse(sql)[0], target_table)
+    return tracer._edges, tracer.ctes
+
+# Whole-query results as immutable (edges, ctes) snapshots; callers merge them into their own state.
+# The AST is not kept: CTE bodies are stored as detached copies so they do not pin their statement.
+@functools.lru_cache(maxsize=256)
+def _trace_cached(sql: str, dialect: Optional[str], workers: int) -> Tuple[tuple, tuple]:
+    tracer = SQLLineageTracer(dialect, workers)
+    for statement in _get_dialect(dialect).parse(sql):
+        if statement is not None:
+            tracer._process_node(statement, 'result')
+    edges = tuple((target, tuple(sources)) for target, sources in tracer._edges.items())
+    return edges, tuple((name, body.copy()) for name, body in tracer.ctes.items())
+
+def clear_lineage_cache():
+    _trace_cached.cache_clear()
 
 class SQLLineage:
-    def __init__(self):
-        self.lineage = {}
-        self.cte_definitions = {}
-        self.subquery_aliases = {}
-
-    def parse_query(self, query: str) -> Dict[str, Set[str]]:
-        statements = sqlparse.parse(query)
-        for statement in statements:
-            self._analyze_statement(statement)
+    """Column lineage accumulated over parse_query calls; each query is traced by SQLLineageTracer."""
+
+    def __init__(self, dialect: Optional[str] = None):
+        self.dialect = dialect
+        # Column names are interned to ids; _adj[id] holds a target's source ids, None for pure sources
+        self._sym: Dict[str, int] = {}
+        self._sym_inv: List[str] = []
+        self._adj: List[Optional[Set[int]]] = []
+        self._targets: List[int] = []
+        # Materialized lineage dict, rebuilt on the next read after any edge changes
+        self._lineage_view: Optional[Dict[str, Set[str]]] = None
+        self.cte_definitions: Dict[str, exp.Expression] = {}
+
+    @property
+    def lineage(self) -> Dict[str, Set[str]]:
+        if self._lineage_view is None:
+            names = self._sym_inv
+            self._lineage_view = {names[target]: {names[source] for source in self._adj[target]} for target in self._targets}
+        return self._lineage_view
+
+    def _id(self, name: str) -> int:
+        sym = self._sym.get(name)
+        if sym is None:
+            sym = self._sym[name] = len(self._sym_inv)
+            self._sym_inv.append(name)
+            self._adj.append(None)
+        return sym
+
+    def _target_id(self, target: str) -> int:
+        tid = self._id(target)
+        if self._adj[tid] is None:
+            self._adj[tid] = set()
+            self._targets.append(tid)
+            self._lineage_view = None
+        return tid
+
+    def _add_sources(self, target: str, sources: Iterable[str]):
+        self._adj[self._target_id(target)].update(self._id(source) for source in sources)
+        self._lineage_view = None
+
+    def parse_query(self, query: Union[str, TextIO]) -> Dict[str, Set[str]]:
+        tracer = SQLLineageTracer(self.dialect)
+        for target, sources in tracer.trace_lineage(query).items():
+            self._add_sources(target, sources)
+        self.cte_definitions.update(tracer.ctes)
         return self.lineage
 
-    def _analyze_statement(self, statement, parent_alias=None):
-        if isinstance(statement, sqlparse.sql.Statement):
-            stmt_type = statement.get_type()
-        else:
-            stmt_type = self._infer_statement_type(statement)
-
-        if stmt_type == 'SELECT':
-            return self._analyze_select(statement, parent_alias)
-        elif stmt_type == 'INSERT':
-            return self._analyze_insert(statement)
-        elif stmt_type == 'UPDATE':
-            return self._analyze_update(statement)
-        elif stmt_type == 'DELETE':
-            return self._analyze_delete(statement)
-        elif stmt_type == 'CREATE':
-            return self._analyze_create(statement)
-
-    def _infer_statement_type(self, statement):
-        first_token = statement.token_first()
-        if first_token:
-            if first_token.ttype is sqlparse.tokens.DML:
-                return first_token.value.upper()
-            elif first_token.ttype is sqlparse.tokens.DDL:
-                return first_token.value.upper()
-        return 'UNKNOWN'
-
-    def _analyze_select(self, statement, parent_alias=None):
-        ctes = self._extract_ctes(statement)
-        for cte_name, cte_query in ctes:
-            self.cte_definitions[cte_name] = cte_query
-            self._analyze_statement(cte_query, cte_name)
-
-        select_items = self._extract_select_items(statement)
-        from_tables, subqueries = self._extract_from_tables_and_subqueries(statement)
-        where_columns = self._extract_where_columns(statement)
-        join_columns = self._extract_join_columns(statement)
-
-        for subq_alias, subq in subqueries:
-            self.subquery_aliases[subq_alias] = self._analyze_statement(subq, subq_alias)
-
-        for item in select_items:
-            target = f"{parent_alias}.{item}" if parent_alias else item
-            self.lineage[target] = set()
-            for table in from_tables:
-                self.lineage[target].add(f"{table}.{item.split('.')[-1]}")
-            for subq_alias in self.subquery_aliases:
-                if item in self.subquery_aliases[subq_alias]:
-                    self.lineage[target].update(self.subquery_aliases[subq_alias][item])
-            self.lineage[target].update(where_columns)
-            self.lineage[target].update(join_columns)
+class SQLLineageTracer:
+    """Column lineage from the sqlglot AST; WHERE/JOIN columns feed every output column."""
+
+    # Handler per node class, tried in order; results are cached per exact type in _node_handlers
+    _NODE_TYPES = (
+        (exp.Select, '_handle_select'),
+        (exp.SetOperation, '_handle_union'),
+        (exp.Insert, '_handle_insert'),
+        (exp.Update, '_handle_update'),
+        (exp.Create, '_handle_create'),
+        (exp.Subquery, '_handle_subquery'),
+    )
+    _node_handlers: Dict[type, Optional[str]] = {}
+    # Expression classes that end the source-column walk, cached per exact type in _source_kinds
+    _SOURCE_TYPES = ((exp.Column, 'column'), (exp.Star, 'star'), (exp.Query, 'query'))
+    _source_kinds: Dict[type, Optional[str]] = {}
+
+    __slots__ = ('dialect', 'workers', '_edges', 'ctes', 'table_aliases')
+
+    def __init__(self, dialect: Optional[str] = None, workers: int = 1):
+        self.dialect = dialect
+        # With workers > 1, CTE bodies and UNION arms are traced in a process pool
+        self.workers = workers
+        self._edges: DefaultDict[ColumnRef, Collection[ColumnRef]] = defaultdict(list)
+        self.ctes: Dict[str, exp.Expression] = {}
+        self.table_aliases: Dict[str, str] = {}
 
+    def trace_lineage(self, sql: Union[str, TextIO]) -> Dict[str, Set[str]]:
+        if not isinstance(sql, str):
+            sql = sql.read()
+        edges, ctes = _trace_cached(sql, self.dialect, self.workers)
+        for target, sources in edges:
+            for source in sources:
+                self._add_edge(target, source)
+        # The cached bodies are shared by every caller, so each tracer gets its own copies to modify
+        self.ctes.update((name, body.copy()) for name, body in ctes)
         return self.lineage
 
-    def _analyze_insert(self, statement):
-        target_table = self._extract_insert_target(statement)
-        source_query = self._extract_insert_source(statement)
-        self._analyze_statement(source_query)
-        
-        for col, sources in self.lineage.items():
-            self.lineage[f"{target_table}.{col}"] = sources
-
-    def _analyze_update(self, statement):
-        target_table = self._extract_update_target(statement)
-        set_items = self._extract_set_items(statement)
-        where_columns = self._extract_where_columns(statement)
-
-        for item in set_items:
-            self.lineage[f"{target_table}.{item}"] = set(where_columns)
-
-    def _analyze_delete(self, statement):
-        target_table = self._extract_delete_target(statement)
-        where_columns = self._extract_where_columns(statement)
-
-        for col in where_columns:
-            self.lineage[f"{target_table}.{col}"] = set(where_columns)
-
-    def _analyze_create(self, statement):
-        table_name = self._extract_create_table_name(statement)
-        columns = self._extract_create_columns(statement)
-        
-        for col in columns:
-            self.lineage[f"{table_name}.{col}"] = set()
-
-    def _extract_ctes(self, statement) -> List[Tuple[str, sqlparse.sql.Statement]]:
-        ctes = []
-        with_token = next((token for token in statement.tokens if token.is_keyword and token.normalized == 'WITH'), None)
-        if with_token:
-            cte_list = with_token.parent
-            for token in cte_list.tokens:
-                if isinstance(token, Identifier):
-                    cte_name = token.get_real_name()
-                    cte_query = token.tokens[-1]
-                    ctes.append((cte_name, cte_query))
-        return ctes
-
-    def _extract_select_items(self, statement) -> List[str]:
-        select_items = []
-        select_token = next(token for token in statement.tokens if token.ttype is sqlparse.tokens.DML and token.value.upper() == 'SELECT')
-        select_idx = statement.token_index(select_token)
-        identifier_list = statement.tokens[select_idx + 1]
-        if isinstance(identifier_list, IdentifierList):
-            for identifier in identifier_list.get_identifiers():
-                select_items.append(str(identifier))
-        elif isinstance(identifier_list, Identifier):
-            select_items.append(str(identifier_list))
-        return select_items
-
-    def _extract_from_tables_and_subqueries(self, statement) -> Tuple[List[str], List[Tuple[str, sqlparse.sql.Statement]]]:
-        from_seen = False
-        tables = []
-        subqueries = []
-        for token in statement.tokens:
-            if from_seen:
-                if isinstance(token, Identifier):
-                    tables.append(token.get_real_name())
-                elif isinstance(token, IdentifierList):
-                    for identifier in token.get_identifiers():
-                        if isinstance(identifier, Identifier):
-                            tables.append(identifier.get_real_name())
-                        elif isinstance(identifier, Parenthesis):
-                            alias = self._get_alias(identifier)
-                            subqueries.append((alias, identifier.tokens[1]))
-            elif token.ttype is sqlparse.tokens.Keyword and token.value.upper() == 'FROM':
-                from_seen = True
-        return tables, subqueries
-
-    def _get_alias(self, token):
-        alias = None
-        for t in token.tokens:
-            if t.ttype is sqlparse.tokens.Keyword and t.value.upper() == 'AS':
-                alias = str(token.tokens[token.tokens.index(t) + 1])
-        return alias or f"subquery_{len(self.subquery_aliases)}"
-
-    def _extract_where_columns(self, statement) -> Set[str]:
-        columns = set()
-        where_clause = next((token for token in statement.tokens if isinstance(token, Where)), None)
-        if where_clause:
-            columns.update(self._extract_columns_from_token(where_clause))
-        return columns
-
-    def _extract_join_columns(self, statement) -> Set[str]:
-        columns = set()
-        join_seen = False
-        for token in statement.tokens:
-            if token.ttype is sqlparse.tokens.Keyword and 'JOIN' in token.value.upper():
-                join_seen = True
-            elif join_seen:
-                columns.update(self._extract_columns_from_token(token))
-                if token.ttype is sqlparse.tokens.Keyword and token.value.upper() in ('WHERE', 'GROUP', 'HAVING', 'ORDER'):
-                    break
-        return columns
-
-    def _extract_columns_from_token(self, token) -> Set[str]:
-        columns = set()
-        if isinstance(token, Comparison):
-            columns.add(str(token.left))
-            columns.add(str(token.right))
-        elif isinstance(token, Function):
-            for t in token.tokens:
-                if isinstance(t, Identifier):
-                    columns.add(str(t))
-        elif isinstance(token, Identifier):
-            columns.add(str(token))
-        elif hasattr(token, 'tokens'):
-            for t in token.tokens:
-                columns.update(self._extract_columns_from_token(t))
-        return columns
-
-    def _extract_insert_target(self, statement) -> str:
-        insert_token = next(token for token in statement.tokens if token.ttype is sqlparse.tokens.DML and token.value.upper() == 'INSERT')
-        into_token = statement.token_next_by_instance(0, Identifier)
-        return into_token.get_real_name()
-
-    def _extract_insert_source(self, statement) -> sqlparse.sql.Statement:
-        select_token = next(token for token in statement.tokens if isinstance(token, sqlparse.sql.Statement) and self._infer_statement_type(token) == 'SELECT')
-        return select_token
-
-    def _extract_update_target(self, statement) -> str:
-        update_token = next(token for token in statement.tokens if token.ttype is sqlparse.tokens.DML and token.value.upper() == 'UPDATE')
-        target_token = statement.token_next_by_instance(0, Identifier)
-        return target_token.get_real_name()
-
-    def _extract_set_items(self, statement) -> List[str]:
-        set_items = []
-        set_seen = False
-        for token in statement.tokens:
-            if set_seen and isinstance(token, Comparison):
-                set_items.append(str(token.left))
-            elif token.ttype is sqlparse.tokens.Keyword and token.value.upper() == 'SET':
-                set_seen = True
-        return set_items
-
-    def _extract_delete_target(self, statement) -> str:
-        from_token = next(token for token in statement.tokens if token.ttype is sqlparse.tokens.Keyword and token.value.upper() == 'FROM')
-        target_token = statement.token_next_by_instance(statement.token_index(from_token), Identifier)
-        return target_token.get_real_name()
-
-    def _extract_create_table_name(self, statement) -> str:
-        create_token = next(token for token in statement.tokens if token.ttype is sqlparse.tokens.DDL and token.value.upper() == 'CREATE')
-        table_token = statement.token_next_by_instance(statement.token_index(create_token), Identifier)
-        return table_token.get_real_name()
-
-    def _extract_create_columns(self, statement) -> List[str]:
-        columns = []
-        parenthesis = next(token for token in statement.tokens if isinstance(token, sqlparse.sql.Parenthesis))
-        for token in parenthesis.tokens:
-            if isinstance(token, Identifier):
-                columns.append(token.get_real_name())
-        return columns
+    def trace_lineage_many(self, sqls: Iterable[Union[str, TextIO]]) -> List[Dict[str, Set[str]]]:
+        """Trace each query separately; results are returned per query and not merged into this tracer."""
+        return [SQLLineageTracer(self.dialect, self.workers).trace_lineage(sql) for sql in sqls]
+
+    @property
+    def lineage(self) -> Dict[str, Set[str]]:
+        # JOIN/WHERE sources repeat under every target, so each dotted name is built once and shared
+        names: Dict[ColumnRef, str] = {}
+
+        def qualified(source: ColumnRef) -> str:
+            name = names.get(source)
+            if name is None:
+                name = names[source] = f"{source[0]}.{source[1]}" if source[0] else source[1]
+            return name
+
+        return {f"{table}.{column}": {qualified(source) for source in sources} for (table, column), sources in self._edges.items()}
+
+    @staticmethod
+    def _resolve_type(cache: Dict[type, Optional[str]], types, node_type: type) -> Optional[str]:
+        name = cache.get(node_type, False)
+        if name is False:
+            name = cache[node_type] = next((name for cls, name in types if issubclass(node_type, cls)), None)
+        return name
+
+    def _process_node(self, node: exp.Expression, target_table: str):
+        handler = self._resolve_type(self._node_handlers, self._NODE_TYPES, type(node))
+        if handler:
+            getattr(self, handler)(node, target_table)
+
+    def _handle_subquery(self, node: exp.Subquery, target_table: str):
+        self._process_node(node.this, target_table)
+
+    def _handle_with(self, node: exp.Expression):
+        with_ = node.args.get('with_')
+        if with_:
+            for cte in with_.expressions:
+                self.ctes[cte.alias] = cte.this
+            # CTE references resolve to "cte.column" edges, so the bodies are independent of each other
+            self._process_subtrees([(cte.this, cte.alias) for cte in with_.expressions])
+
+    def _process_subtrees(self, subtrees: List[Tuple[exp.Expression, str]]):
+        if self.workers <= 1 or len(subtrees) < 2:
+            for node, target_table in subtrees:
+                self._process_node(node, target_table)
+            return
+        sqls = [node.sql(dialect=self.dialect) for node, _ in subtrees]
+        target_tables = [target_table for _, target_table in subtrees]
+        count = len(subtrees)
+        results = _get_pool(self.workers).map(_trace_subtree, sqls, target_tables, [self.dialect] * count, [self.table_aliases] * count)
+        for edges, ctes in results:
+            for target, sources in edges.items():
+                for source in sources:
+                    self._add_edge(target, source)
+            self.ctes.update(ctes)
+
+    def _handle_select(self, node: exp.Select, target_table: str):
+        # Aliases are scoped to this SELECT; nested queries see but do not leak theirs
+        outer_aliases = self.table_aliases
+        self.table_aliases = dict(outer_aliases)
+
+        self._handle_with(node)
+        from_tables = self._process_from(node)
+        target_table = sys.intern(target_table)
+        targets = [(target_table, sys.intern(projection.alias_or_name)) for projection in node.expressions]
+        get_source_columns = self._get_source_columns
+        add_lineage = self._add_lineage
+        for projection, target in zip(node.expressions, targets):
+            for source in get_source_columns(projection, from_tables):
+                add_lineage(target, source)
+        self._process_join(node, targets, from_tables)
+        self._process_where(node, targets, from_tables)
+
+        self.table_aliases = outer_aliases
+
+    def _handle_union(self, node: exp.SetOperation, target_table: str):
+        self._handle_with(node)
+        self._process_subtrees([(node.left, target_table), (node.right, target_table)])
+
+    def _handle_insert(self, node: exp.Insert, target_table: Optional[str] = None):
+        target = node.this
+        if isinstance(target, exp.Schema):
+            table_name = target.this.name
+            columns = [column.name for column in target.expressions]
+        else:
+            table_name = target.name
+            columns = []
+
+        query = node.expression
+        if not isinstance(query, exp.Query):
+            return
+        inserted = self._collect_lineage(query, table_name)
+
+        # An explicit column list maps projections to target columns by position
+        renames = {}
+        if columns and isinstance(query, exp.Select):
+            for projection, column in zip(query.expressions, columns):
+                renames[(table_name, projection.alias_or_name)] = (table_name, column)
+        for target_column, sources in inserted.items():
+            for source in sources:
+                self._add_lineage(renames.get(target_column, target_column), source)
+
+    def _handle_update(self, node: exp.Update, target_table: Optional[str] = None):
+        outer_aliases = self.table_aliases
+        self.table_aliases = dict(outer_aliases)
+
+        table = node.this
+        self.table_aliases[table.alias_or_name] = table.name
+        from_tables = [table.name] + self._process_from(node)
+        targets = []
+        for assignment in node.expressions:
+            target = (table.name, assignment.this.name)
+            targets.append(target)
+            for source in self._get_source_columns(assignment.expression, from_tables):
+                self._add_lineage(target, source)
+        self._process_where(node, targets, from_tables)
+
+        self.table_aliases = outer_aliases
+
+    def _handle_create(self, node: exp.Create, target_table: Optional[str] = None):
+        query = node.expression
+        if isinstance(query, exp.Query):
+            target = node.this
+            table_name = target.this.name if isinstance(target, exp.Schema) else target.name
+            self._process_node(query, table_name)
+
+    def _process_from(self, node: exp.Expression) -> List[str]:
+        from_tables = []
+        sources = []
+        from_ = node.args.get('from_')
+        if from_:
+            sources.append(from_.this)
+        sources.extend(join.this for join in node.args.get('joins') or [])
+
+        for source in sources:
+            if isinstance(source, exp.Table):
+                self.table_aliases[source.alias_or_name] = source.name
+                from_tables.append(source.name)
+            elif isinstance(source, exp.Subquery):
+                alias = source.alias_or_name or f"subquery_{len(from_tables)}"
+                self._process_node(source.this, alias)
+                self.table_aliases[alias] = alias
+                from_tables.append(alias)
+        return from_tables
+
+    def _process_join(self, node: exp.Expression, targets: List[ColumnRef], from_tables: List[str]):
+        for join in node.args.get('joins') or []:
+            condition = join.args.get('on')
+            if condition is not None:
+                self._add_lineage_to_all(targets, self._get_source_columns(condition, from_tables))
+
+    def _process_where(self, node: exp.Expression, targets: List[ColumnRef], from_tables: List[str]):
+        where = node.args.get('where')
+        if where is not None:
+            self._add_lineage_to_all(targets, self._get_source_columns(where, from_tables))
+
+    def _get_source_columns(self, root: exp.Expression, from_tables: List[str]) -> List[ColumnRef]:
+        sources = []
+        # Children are pushed in reverse so sources come out in the original left-to-right order
+        stack = [root]
+        while stack:
+            expr = stack.pop()
+            kind = self._resolve_type(self._source_kinds, self._SOURCE_TYPES, type(expr))
+            if kind == 'column':
+                if expr.table:
+                    sources.append((expr.table, expr.name))
+                elif len(from_tables) == 1:
+                    sources.append((from_tables[0], expr.name))
+                else:
+                    sources.append(('', expr.name))
+            elif kind == 'star':
+                sources.extend((table, '*') for table in from_tables)
+            elif kind == 'query':
+                # Scalar, IN and EXISTS subqueries feed the enclosing column directly
+                subquery_lineage = self._collect_lineage(expr, 'subquery')
+                sources.extend(source for column_sources in subquery_lineage.values() for source in column_sources)
+            else:
+                stack.extend(reversed(list(expr.iter_expressions())))
+        return sources
+
+    def _collect_lineage(self, node: exp.Expression, target_table: str) -> Dict[ColumnRef, Collection[ColumnRef]]:
+        outer_edges = self._edges
+        self._edges = defaultdict(list)
+        self._process_node(node, target_table)
+        collected = self._edges
+        self._edges = outer_edges
+        return collected
+
+    def _add_lineage(self, target: ColumnRef, source: ColumnRef):
+        table = source[0]
+        if table:
+            source = (self.table_aliases.get(table, table), source[1])
+        if source != target:
+            self._add_edge(target, source)
+
+    def _add_lineage_to_all(self, targets: List[ColumnRef], sources: List[ColumnRef]):
+        # Resolve each source's alias once rather than once per target
+        resolve = self.table_aliases.get
+        resolved = [(resolve(table, table), column) if table else (table, column) for table, column in sources]
+        add_edge = self._add_edge
+        for source in resolved:
+            for target in targets:
+                if source != target:
+                    add_edge(target, source)
+
+    def _add_edge(self, target: ColumnRef, source: ColumnRef):
+        sources = self._edges[target]
+        if type(sources) is list:
+            if source not in sources:
+                sources.append(source)
+                if len(sources) > _SMALL_SOURCES:
+                    self._edges[target] = set(sources)
+        else:
+            sources.add(source)
 
 # Usage example
 if __name__ == "__main__":
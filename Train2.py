@@ -1,9 +1,11 @@
- import numpy as np
+import numpy as np
 import os
-from transformers import T5ForConditionalGeneration, Trainer, TrainingArguments
+from transformers import T5Config, T5ForConditionalGeneration, Trainer, TrainingArguments, TrainerCallback, EarlyStoppingCallback
 from sklearn.model_selection import KFold
 import evaluate
 import torch
+from accelerate import PartialState
+import optuna
 from embed import tokenizer
 import datetime
 import warnings
@@ -12,33 +14,74 @@ import shutil
 
 warnings.filterwarnings("ignore")
 
+# T5 activations overflow in float16, so mixed precision is only enabled where bfloat16 is supported
+USE_BF16 = torch.cuda.is_available() and torch.cuda.is_bf16_supported()
+
+DATALOADER_WORKERS = min(8, (os.cpu_count() or 1) // 2)
+
+# Read the pretrained checkpoint once; every fold of every trial starts from these CPU weights
+BASE_CONFIG = T5Config.from_pretrained('t5-base')
+BASE_STATE_DICT = T5ForConditionalGeneration.from_pretrained('t5-base').state_dict()
+
+# Loaded once; compute_metrics runs after every epoch of every fold and trial
+ROUGE = evaluate.load("rouge")
+
+def is_main_process():
+    """Under `accelerate launch --multi_gpu` or torchrun, Trainer trains each fold data-parallel
+    across all ranks; only the main rank writes models and parameter files."""
+    return PartialState().is_main_process
+
 def compute_metrics(eval_preds):
     preds, labels = eval_preds
     if isinstance(preds, tuple):
         preds = preds[0]
-    decoded_preds = tokenizer.batch_decode(preds, skip_special_tokens=True)
-    labels = np.where(labels != -100, labels, tokenizer.pad_token_id)
-    decoded_labels = tokenizer.batch_decode(labels, skip_special_tokens=True)
+    if preds.ndim == 3:
+        # Without predict_with_generate the model returns logits; decode the greedy tokens
+        preds = preds.argmax(-1)
+    decoded_preds = tokenizer.batch_decode(preds, skip_special_tokens=True, clean_up_tokenization_spaces=False)
+    # The T5 vocabulary fits in int32; mask the ignored positions in place on the narrowed copy
+    labels = np.asarray(labels, dtype=np.int32)
+    labels[labels == -100] = tokenizer.pad_token_id
+    decoded_labels = tokenizer.batch_decode(labels, skip_special_tokens=True, clean_up_tokenization_spaces=False)
     
-    metric = evaluate.load("rouge")
-    result = metric.compute(predictions=decoded_preds, references=decoded_labels, use_stemmer=True)
+    result = ROUGE.compute(predictions=decoded_preds, references=decoded_labels, use_stemmer=True, use_aggregator=True)
     
     return {
-        'rouge1': result['rouge1'].mid.fmeasure,
-        'rouge2': result['rouge2'].mid.fmeasure,
-        'rougeL': result['rougeL'].mid.fmeasure,
+        'rouge1': result['rouge1'],
+        'rouge2': result['rouge2'],
+        'rougeL': result['rougeL'],
     }
 
-def train(train_dataset, eval_dataset, params, data_collator):
-    model = T5ForConditionalGeneration.from_pretrained('t5-base')
+class PruningCallback(TrainerCallback):
+    """Report the average ROUGE of each epoch's evaluation to an Optuna trial and stop it if it should be pruned."""
+    def __init__(self, trial):
+        self.trial = trial
+
+    def on_evaluate(self, args, state, control, metrics=None, **kwargs):
+        rouge_avg = (metrics['eval_rouge1'] + metrics['eval_rouge2'] + metrics['eval_rougeL']) / 3
+        self.trial.report(rouge_avg, step=round(state.epoch))
+        if self.trial.should_prune():
+            raise optuna.TrialPruned()
+
+def train(train_dataset, eval_dataset, params, data_collator, callbacks=None):
+    model = T5ForConditionalGeneration(BASE_CONFIG)
+    # load_state_dict copies into the new model's own parameters, leaving BASE_STATE_DICT untouched
+    model.load_state_dict(BASE_STATE_DICT)
     
     training_args = TrainingArguments(
         output_dir='./results',
         num_train_epochs=params['num_train_epochs'],
         per_device_train_batch_size=params['batch_size'],
         per_device_eval_batch_size=params['batch_size'],
+        gradient_accumulation_steps=params['gradient_accumulation_steps'],
+        # Batch SQL statements of similar token length together so little of each batch is padding
+        group_by_length=True,
+        length_column_name="length",
         learning_rate=params['learning_rate'],
-        weight_decay=params['weight_decay'],
+        # Adafactor factors the second moment and keeps no first moment, so optimizer state is a
+        # fraction of AdamW's; T5 was pretrained with it at a constant learning rate
+        optim="adafactor",
+        lr_scheduler_type="constant",
         logging_dir='./logs',
         logging_steps=100,
         evaluation_strategy="epoch",
@@ -46,6 +89,17 @@ def train(train_dataset, eval_dataset, params, data_collator):
         load_best_model_at_end=True,
         metric_for_best_model="eval_loss",
         greater_is_better=False,
+        # Keep only the best and the latest checkpoint of each fold on disk
+        save_total_limit=1,
+        bf16=USE_BF16,
+        bf16_full_eval=USE_BF16,
+        # Every bf16-capable GPU also has TF32 Tensor Cores for the remaining float32 matmuls
+        tf32=True if USE_BF16 else None,
+        # Collate in background workers into pinned memory so host-to-device copies overlap compute
+        dataloader_pin_memory=True,
+        dataloader_num_workers=DATALOADER_WORKERS,
+        dataloader_persistent_workers=DATALOADER_WORKERS > 0,
+        dataloader_prefetch_factor=4 if DATALOADER_WORKERS > 0 else None,
     )
     
     trainer = Trainer(
@@ -55,25 +109,31 @@ def train(train_dataset, eval_dataset, params, data_collator):
         eval_dataset=eval_dataset,
         compute_metrics=compute_metrics,
         data_collator=data_collator,
+        # Stop once eval_loss stops improving; load_best_model_at_end restores the best epoch
+        callbacks=[EarlyStoppingCallback(early_stopping_patience=1, early_stopping_threshold=0.001)] + (callbacks or []),
     )
     
     trainer.train()
     return trainer.model
 
-def cross_validation(dataset, eval_dataset, params, model_save_path, data_collator, n_splits=5):
+def run_folds(dataset, eval_dataset, params, data_collator, n_splits=5, trial=None):
+    """Train and validate one model per fold; return the mean ROUGE scores and the best fold's model."""
     kf = KFold(n_splits=n_splits, shuffle=True, random_state=42)
     
     rouge1_list, rouge2_list, rougeL_list = [], [], []
     best_model = None
     best_rouge_avg = -1
     
-    for fold, (train_index, val_index) in enumerate(kf.split(dataset)):
+    for fold, (train_index, val_index) in enumerate(kf.split(np.arange(len(dataset)))):
         print(f"Training fold {fold + 1}/{n_splits}")
         
-        train_dataset = [dataset[i] for i in train_index]
-        val_dataset = [dataset[i] for i in val_index]
+        # `dataset` is a datasets.Dataset, so folds are index mappings over the same Arrow table
+        train_dataset = dataset.select(train_index)
+        val_dataset = dataset.select(val_index)
         
-        model = train(train_dataset, eval_dataset, params, data_collator)
+        # The first fold's learning curve decides whether the trial is worth finishing
+        callbacks = [PruningCallback(trial)] if trial is not None and fold == 0 else None
+        model = train(train_dataset, eval_dataset, params, data_collator, callbacks)
         
         # Validate model
         trainer = Trainer(
@@ -87,6 +147,14 @@ def cross_validation(dataset, eval_dataset, params, model_save_path, data_collat
         rouge2_list.append(metrics['eval_rouge2'])
         rougeL_list.append(metrics['eval_rougeL'])
         
+        if trial is not None and fold == 0:
+            # Abandon configurations whose first fold is clearly worse than the best first fold so far
+            trial.set_user_attr('first_fold_loss', metrics['eval_loss'])
+            earlier_losses = [t.user_attrs['first_fold_loss'] for t in trial.study.get_trials(deepcopy=False)
+                              if t.number != trial.number and 'first_fold_loss' in t.user_attrs]
+            if earlier_losses and metrics['eval_loss'] > 1.2 * min(earlier_losses):
+                raise optuna.TrialPruned()
+        
         print(f"Fold {fold + 1} - ROUGE-1: {metrics['eval_rouge1']:.3f}, ROUGE-2: {metrics['eval_rouge2']:.3f}, ROUGE-L: {metrics['eval_rougeL']:.3f}")
         
         # Check if this model is the best so far
@@ -95,57 +163,69 @@ def cross_validation(dataset, eval_dataset, params, model_save_path, data_collat
             best_rouge_avg = current_rouge_avg
             best_model = model
     
+    return np.mean(rouge1_list), np.mean(rouge2_list), np.mean(rougeL_list), best_model
+
+def cross_validation(dataset, eval_dataset, params, model_save_path, data_collator, n_splits=5):
+    rouge1, rouge2, rougeL, best_model = run_folds(dataset, eval_dataset, params, data_collator, n_splits)
+    
     # Save the best model
-    if best_model:
+    if best_model and is_main_process():
         best_model.save_pretrained(model_save_path)
         print(f"Best model saved to {model_save_path}")
     
-    return np.mean(rouge1_list), np.mean(rouge2_list), np.mean(rougeL_list)
+    return rouge1, rouge2, rougeL
 
-def optimize_hyperparameters(dataset, eval_dataset, model_save_path, data_collator):
-    learning_rate_candidates = [1e-5, 3e-5, 5e-5]
-    batch_size_candidates = [4, 8, 16]
+def optimize_hyperparameters(dataset, eval_dataset, model_save_path, data_collator, n_trials=20):
     num_epochs_candidates = [3, 5, 10]
-    weight_decay_candidates = [0.01, 0.1]
+    # Only the best trial's weights are kept, as CPU tensors, and written to disk once the search ends
+    best = {'rouge_avg': -1, 'state_dict': None}
     
-    best_params = None
-    best_rouge_avg = -1
-    best_model_path = None
-    
-    for lr in learning_rate_candidates:
-        for bs in batch_size_candidates:
-            for epochs in num_epochs_candidates:
-                for wd in weight_decay_candidates:
-                    params = {
-                        'learning_rate': lr,
-                        'batch_size': bs,
-                        'num_train_epochs': epochs,
-                        'weight_decay': wd,
-                    }
-                    
-                    current_model_path = os.path.join(model_save_path, f"lr{lr}_bs{bs}_epochs{epochs}_wd{wd}")
-                    os.makedirs(current_model_path, exist_ok=True)
-                    
-                    rouge1, rouge2, rougeL = cross_validation(dataset, eval_dataset, params, current_model_path, data_collator)
-                    current_rouge_avg = (rouge1 + rouge2 + rougeL) / 3
-                    
-                    print(f"Params: {params}")
-                    print(f"Results: ROUGE-1={rouge1:.3f}, ROUGE-2={rouge2:.3f}, ROUGE-L={rougeL:.3f}")
-                    
-                    if current_rouge_avg > best_rouge_avg:
-                        best_rouge_avg = current_rouge_avg
-                        best_params = params.copy()
-                        best_model_path = current_model_path
-    
-    # Move the best model to the final location
-    final_best_model_path = os.path.join(model_save_path, "best_model")
-    if os.path.exists(final_best_model_path):
-        shutil.rmtree(final_best_model_path)
-    shutil.move(best_model_path, final_best_model_path)
+    def objective(trial):
+        params = {
+            'learning_rate': trial.suggest_float('learning_rate', 1e-5, 5e-5, log=True),
+            # Per-device batch stays at 4; accumulation gives effective batches of 4, 8 and 16
+            'batch_size': 4,
+            'gradient_accumulation_steps': trial.suggest_categorical('gradient_accumulation_steps', [1, 2, 4]),
+            'num_train_epochs': trial.suggest_categorical('num_train_epochs', num_epochs_candidates),
+        }
+        
+        trial.set_user_attr('params', params)
+        
+        rouge1, rouge2, rougeL, model = run_folds(dataset, eval_dataset, params, data_collator, trial=trial)
+        rouge_avg = (rouge1 + rouge2 + rougeL) / 3
+        
+        print(f"Params: {params}")
+        print(f"Results: ROUGE-1={rouge1:.3f}, ROUGE-2={rouge2:.3f}, ROUGE-L={rougeL:.3f}")
+        
+        if rouge_avg > best['rouge_avg']:
+            best['rouge_avg'] = rouge_avg
+            best['state_dict'] = {k: v.detach().cpu().clone() for k, v in model.state_dict().items()}
+        
+        return rouge_avg
+    
+    # TPE proposes configurations from earlier results; Hyperband stops weak ones after their first epochs.
+    # The sampler is seeded so every rank of a distributed run suggests the same trials.
+    study = optuna.create_study(
+        direction="maximize",
+        sampler=optuna.samplers.TPESampler(seed=42),
+        pruner=optuna.pruners.HyperbandPruner(min_resource=1, max_resource=max(num_epochs_candidates)),
+    )
+    study.optimize(objective, n_trials=n_trials)
     
-    # Save best parameters
-    with open(os.path.join(model_save_path, "best_params.json"), "w") as f:
-        json.dump(best_params, f)
+    best_params = study.best_trial.user_attrs['params']
+    
+    # Write the best model to its final location
+    final_best_model_path = os.path.join(model_save_path, "best_model")
+    if is_main_process():
+        if os.path.exists(final_best_model_path):
+            shutil.rmtree(final_best_model_path)
+        best_model = T5ForConditionalGeneration(BASE_CONFIG)
+        best_model.load_state_dict(best['state_dict'])
+        best_model.save_pretrained(final_best_model_path)
+        
+        # Save best parameters
+        with open(os.path.join(model_save_path, "best_params.json"), "w") as f:
+            json.dump(best_params, f)
     
     print(f"Best model saved to {final_best_model_path}")
     print(f"Best parameters: {best_params}")
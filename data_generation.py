@@ -1,4 +1,5 @@
 import os
+from pathlib import Path
 
 # Example SQL queries and lineage descriptions
 examples = [
@@ -478,21 +479,22 @@ examples = [
 # Function to create the Input folder and subfolders with sql.txt and output.txt
 def create_input_folders(examples):
     input_folder = "Input"
-    if not os.path.exists(input_folder):
-        os.makedirs(input_folder)
+    os.makedirs(input_folder, exist_ok=True)
     
-    for i, example in enumerate(examples, start=1):
-        subfolder_path = os.path.join(input_folder, str(i))
-        if not os.path.exists(subfolder_path):
-            os.makedirs(subfolder_path)
+    # Several examples are repeated verbatim; write each distinct SQL/lineage pair once
+    seen = set()
+    for example in examples:
+        sql, lineage = example['sql'].strip(), example['lineage'].strip()
+        if (sql, lineage) in seen:
+            continue
+        seen.add((sql, lineage))
         
-        # Write sql.txt
-        with open(os.path.join(subfolder_path, 'sql.txt'), 'w') as f_sql:
-            f_sql.write(example['sql'].strip() + '\n')
+        # Folders are numbered 1..N over the distinct examples
+        subfolder_path = os.path.join(input_folder, str(len(seen)))
+        os.makedirs(subfolder_path, exist_ok=True)
         
-        # Write output.txt
-        with open(os.path.join(subfolder_path, 'output.txt'), 'w') as f_output:
-            f_output.write(example['lineage'].strip() + '\n')
+        Path(subfolder_path, 'sql.txt').write_text(sql + '\n')
+        Path(subfolder_path, 'output.txt').write_text(lineage + '\n')
 
 # Create Input folder with subfolders and files
 create_input_folders(examples)
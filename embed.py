@@ -5,20 +5,35 @@ print("schema_matching|Loading T5 tokenizer, this will take a while...")
 tokenizer = T5Tokenizer.from_pretrained('t5-base')
 print("schema_matching|Done loading T5 tokenizer")
 
+# Tokenization settings of prepare_data; Main2 keys its cached datasets on these
+PROMPT = "Generate SQL lineage: "
+MAX_LENGTH = 512
+# Bump when prepare_data's output changes in a way the settings above do not capture (padding, labels)
+PREPARE_DATA_VERSION = 1
+
 def prepare_data(sql_statements, lineages):
     """Prepare data by tokenizing SQL statements and lineages."""
+    sql_statements = list(sql_statements)
+    lineages = list(lineages)
+
+    # Tokenize each distinct text once and share the encoding between duplicates
+    sql_index = {sql: i for i, sql in enumerate(dict.fromkeys(sql_statements))}
+    lineage_index = {lineage: i for i, lineage in enumerate(dict.fromkeys(lineages))}
+
+    input_texts = [PROMPT + sql for sql in sql_index]
+    input_encodings = tokenizer(input_texts, truncation=True, max_length=MAX_LENGTH)
+
+    with tokenizer.as_target_tokenizer():
+        target_encodings = tokenizer(list(lineage_index), truncation=True, max_length=MAX_LENGTH)
+
     dataset = []
     for sql, lineage in zip(sql_statements, lineages):
-        input_text = "Generate SQL lineage: " + sql
-        input_encodings = tokenizer(input_text, padding="max_length", truncation=True, max_length=512)
-        
-        with tokenizer.as_target_tokenizer():
-            target_encodings = tokenizer(lineage, padding="max_length", truncation=True, max_length=512)
-
+        i = sql_index[sql]
+        j = lineage_index[lineage]
         dataset.append({
-            "input_ids": input_encodings["input_ids"],
-            "attention_mask": input_encodings["attention_mask"],
-            "labels": target_encodings["input_ids"]
+            "input_ids": input_encodings["input_ids"][i],
+            "attention_mask": input_encodings["attention_mask"][i],
+            "labels": target_encodings["input_ids"][j]
         })
     
     return dataset
@@ -1,11 +1,16 @@
 import os
-from transformers import T5ForConditionalGeneration, T5Tokenizer
+from transformers import T5ForConditionalGeneration, T5TokenizerFast
 import json
 import torch
-from collections import Counter
+from itertools import islice
+
+TOKENIZER = T5TokenizerFast.from_pretrained('t5-base')
+MODEL_CACHE = {}
 
 def load_models(model_path):
-    """Load all trained models."""
+    """Load all trained models, reusing the ones already loaded from model_path."""
+    if model_path in MODEL_CACHE:
+        return MODEL_CACHE[model_path]
     models = []
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     for folder in os.listdir(model_path):
@@ -13,25 +18,162 @@ def load_models(model_path):
             model = T5ForConditionalGeneration.from_pretrained(os.path.join(model_path, folder))
             model.to(device)
             model.eval()
+            if device.type == "cuda":
+                # bfloat16 halves memory traffic and runs the matmuls on Tensor Cores; T5 activations
+                # overflow in float16, so GPUs without bfloat16 keep float32
+                if torch.cuda.is_bf16_supported():
+                    model.to(torch.bfloat16)
+                # ensemble_generate calls forward once per decoder step; compiling it fuses each step's
+                # small kernels. dynamic=True avoids a recompile as the cache grows by one token per step
+                model.forward = torch.compile(model.forward, dynamic=True)
+            else:
+                # On CPU, int8 dynamic quantization of the Linear layers speeds up beam search
+                model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
             models.append(model)
+    MODEL_CACHE[model_path] = models
     return models
 
-def predict_lineage(sql, models, tokenizer):
+def to_device(tensor, device):
+    """Copy a CPU tensor to device, letting the copy overlap with GPU work."""
+    if device.type == "cuda":
+        return tensor.pin_memory().to(device, non_blocking=True)
+    return tensor
+
+def predict_lineage(sql, models, tokenizer=TOKENIZER):
     """Predict lineage for a given SQL statement using ensemble of models."""
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    inputs = tokenizer("Generate SQL lineage: " + sql, return_tensors="pt", max_length=512, padding="max_length", truncation=True)
-    input_ids = inputs.input_ids.to(device)
-    attention_mask = inputs.attention_mask.to(device)
+    inputs = tokenizer("Generate SQL lineage: " + sql, return_tensors="pt", max_length=512, truncation=True)
+    input_ids = to_device(inputs.input_ids, device)
+    attention_mask = to_device(inputs.attention_mask, device)
+    
+    with torch.inference_mode():
+        output = ensemble_generate(models, input_ids, attention_mask, max_new_tokens(input_ids))
+    return tokenizer.decode(output[0], skip_special_tokens=True)
+
+def max_new_tokens(input_ids):
+    """Decoding budget for a batch: lineage output is bounded by a multiple of the SQL length."""
+    return min(512, int(1.5 * input_ids.shape[1]) + 32)
+
+def reorder_cache(past_key_values, beam_idx):
+    """Reorder a model's decoder cache to follow the beams that survived the last step."""
+    if hasattr(past_key_values, "reorder_cache"):
+        past_key_values.reorder_cache(beam_idx)
+        return past_key_values
+    return tuple(tuple(t.index_select(0, beam_idx) for t in layer) for layer in past_key_values)
+
+def ensemble_generate(models, input_ids, attention_mask, max_new_tokens, num_beams=4, length_penalty=1.0, early_stopping=True):
+    """Beam search over the average of the models' next-token log-probabilities."""
+    # Every model encodes once and keeps its own decoder cache, but they share a single beam
+    # search, so the ensemble decodes each sequence once instead of once per model. Candidates,
+    # finished hypotheses and stopping follow generate()'s beam search with the same settings.
+    batch_size = input_ids.shape[0]
+    device = input_ids.device
+    config = models[0].config
     
-    predictions = []
-    with torch.no_grad():
-        for model in models:
-            output = model.generate(input_ids, attention_mask=attention_mask, max_length=512, num_return_sequences=1, num_beams=4)
-            prediction = tokenizer.decode(output[0], skip_special_tokens=True)
-            predictions.append(prediction)
+    attention_mask = attention_mask.repeat_interleave(num_beams, dim=0)
+    encoder_outputs = []
+    for model in models:
+        encoded = model.get_encoder()(input_ids=input_ids, attention_mask=attention_mask[::num_beams])
+        encoded.last_hidden_state = encoded.last_hidden_state.repeat_interleave(num_beams, dim=0)
+        encoder_outputs.append(encoded)
+    past_key_values = [None] * len(models)
     
-    # Use the most common prediction as the final result
-    return Counter(predictions).most_common(1)[0][0]
+    # Running beams and the best finished hypotheses of the statements still being decoded
+    running = torch.full((batch_size, num_beams, 1), config.decoder_start_token_id, device=device)
+    # Only the first beam of each statement starts live, so the beams diverge on the first step
+    running_scores = torch.full((batch_size, num_beams), -1e9, device=device)
+    running_scores[:, 0] = 0
+    finished = torch.full((batch_size, num_beams, 1), config.pad_token_id, device=device)
+    finished_scores = torch.full((batch_size, num_beams), -1e9, device=device)
+    is_finished = torch.zeros((batch_size, num_beams), dtype=torch.bool, device=device)
+    can_improve = torch.ones((batch_size, 1), dtype=torch.bool, device=device)
+    # Statements leave the batch once their result is final; outputs are written at their original index
+    active = torch.arange(batch_size, device=device)
+    outputs = [None] * batch_size
+    # Twice the beams are kept as candidates, so enough unfinished ones remain after some end in EOS
+    top_beam_mask = torch.arange(2 * num_beams, device=device) < num_beams
+    
+    for step in range(1, max_new_tokens + 1):
+        batch = active.shape[0]
+        log_probs = 0
+        for i, model in enumerate(models):
+            output = model(encoder_outputs=encoder_outputs[i], attention_mask=attention_mask, decoder_input_ids=running[:, :, -1].reshape(-1, 1),
+                           past_key_values=past_key_values[i], use_cache=True)
+            past_key_values[i] = output.past_key_values
+            log_probs = log_probs + torch.log_softmax(output.logits[:, -1].float(), dim=-1)
+        log_probs = log_probs / len(models)
+        vocab_size = log_probs.shape[-1]
+        
+        scores = (running_scores[:, :, None] + log_probs.view(batch, num_beams, vocab_size)).view(batch, -1)
+        topk_scores, topk_idx = scores.topk(2 * num_beams, dim=-1)
+        topk_beams = topk_idx // vocab_size
+        topk_sequences = torch.cat([running.gather(1, topk_beams[:, :, None].expand(-1, -1, running.shape[-1])), (topk_idx % vocab_size)[:, :, None]], dim=-1)
+        ends = (topk_sequences[:, :, -1] == config.eos_token_id) | (step == max_new_tokens)
+        
+        # The best unfinished candidates keep running
+        running_idx = (topk_scores - 1e9 * ends).topk(num_beams, dim=-1)[1]
+        running = topk_sequences.gather(1, running_idx[:, :, None].expand(-1, -1, topk_sequences.shape[-1]))
+        running_scores = (topk_scores - 1e9 * ends).gather(1, running_idx)
+        beam_idx = (topk_beams.gather(1, running_idx) + torch.arange(batch, device=device)[:, None] * num_beams).view(-1)
+        
+        # Top candidates that just ended join the finished hypotheses, scored with the length penalty
+        candidate_scores = topk_scores / (step ** length_penalty)
+        candidate_scores = candidate_scores - 1e9 * (is_finished.all(-1, keepdim=True) & early_stopping)
+        candidate_scores = candidate_scores - 1e9 * ~can_improve
+        candidate_scores = candidate_scores - 1e9 * ~(ends & top_beam_mask)
+        finished = torch.nn.functional.pad(finished, (0, 1), value=config.pad_token_id)
+        merged = torch.cat([finished, topk_sequences], dim=1)
+        merged_scores = torch.cat([finished_scores, candidate_scores], dim=1)
+        merged_is_finished = torch.cat([is_finished, ends & top_beam_mask], dim=1)
+        finished_scores, keep_idx = merged_scores.topk(num_beams, dim=-1)
+        finished = merged.gather(1, keep_idx[:, :, None].expand(-1, -1, merged.shape[-1]))
+        is_finished = merged_is_finished.gather(1, keep_idx)
+        
+        # A statement is done when its running beams can no longer beat its finished ones
+        best_running = running_scores[:, :1] / (step ** length_penalty)
+        worst_finished = torch.where(is_finished, finished_scores.min(-1, keepdim=True)[0], -1e9)
+        can_improve = can_improve & (best_running > worst_finished).any(-1, keepdim=True)
+        done = ~can_improve[:, 0] | (is_finished.all(-1) & early_stopping) | ends.all(-1)
+        for i in done.nonzero()[:, 0].tolist():
+            outputs[active[i]] = finished[i, 0]
+        
+        keep = ~done
+        if not keep.any():
+            break
+        # Follow the surviving beams in every cache, and drop the rows of finished statements
+        rows = beam_idx.view(batch, num_beams)[keep].view(-1)
+        past_key_values = [reorder_cache(past, rows) for past in past_key_values]
+        if not keep.all():
+            kept_rows = torch.arange(batch * num_beams, device=device).view(batch, num_beams)[keep].view(-1)
+            attention_mask = attention_mask[kept_rows]
+            for encoded in encoder_outputs:
+                encoded.last_hidden_state = encoded.last_hidden_state[kept_rows]
+            active, running, running_scores = active[keep], running[keep], running_scores[keep]
+            finished, finished_scores, is_finished, can_improve = finished[keep], finished_scores[keep], is_finished[keep], can_improve[keep]
+    
+    return torch.nn.utils.rnn.pad_sequence(outputs, batch_first=True, padding_value=config.pad_token_id)
+
+def create_batches(items, batch_size):
+    for i in range(0, len(items), batch_size):
+        yield items[i:i + batch_size]
+
+def predict_lineage_batch(sqls, models, tokenizer=TOKENIZER, batch_size=32):
+    """Predict lineage for a list of SQL statements using ensemble of models."""
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    # Batch statements of similar length together so little padding is encoded or decoded
+    order = sorted(range(len(sqls)), key=lambda i: len(sqls[i]))
+    predictions = [None] * len(sqls)
+    with torch.inference_mode():
+        for batch_indices in create_batches(order, batch_size):
+            batch = [sqls[i] for i in batch_indices]
+            inputs = tokenizer(["Generate SQL lineage: " + sql for sql in batch], return_tensors="pt", max_length=512, padding=True, truncation=True)
+            input_ids = to_device(inputs.input_ids, device)
+            attention_mask = to_device(inputs.attention_mask, device)
+            
+            output = ensemble_generate(models, input_ids, attention_mask, max_new_tokens(input_ids))
+            for i, prediction in zip(batch_indices, tokenizer.batch_decode(output, skip_special_tokens=True)):
+                predictions[i] = prediction
+    return predictions
 
 if __name__ == "__main__":
     # Load the latest model
@@ -41,7 +183,6 @@ if __name__ == "__main__":
 
     print(f"Loading model from: {model_path}")
     models = load_models(model_path)
-    tokenizer = T5Tokenizer.from_pretrained('t5-base')
 
     # Load best parameters
     with open(f"{model_path}/best_params.json", 'r') as f:
@@ -76,7 +217,7 @@ if __name__ == "__main__":
     ORDER BY cte3.total_spent DESC;
     """
 
-    predicted_lineage = predict_lineage(test_sql, models, tokenizer)
+    predicted_lineage = predict_lineage(test_sql, models)
     
     print(f"SQL:\n{test_sql}")
     print(f"\nPredicted Lineage:\n{predicted_lineage}")
@@ -84,20 +225,22 @@ if __name__ == "__main__":
 # Function to evaluate model performance on a test set
 def evaluate_model(model_path, test_sql_file, test_lineage_file):
     models = load_models(model_path)
-    tokenizer = T5Tokenizer.from_pretrained('t5-base')
-    
-    with open(test_sql_file, 'r') as f:
-        test_sql_statements = f.readlines()
-    with open(test_lineage_file, 'r') as f:
-        test_lineages = f.readlines()
 
     correct_predictions = 0
-    total_predictions = len(test_sql_statements)
+    total_predictions = 0
 
-    for sql, true_lineage in zip(test_sql_statements, test_lineages):
-        predicted_lineage = predict_lineage(sql, models, tokenizer)
-        if predicted_lineage.strip() == true_lineage.strip():
-            correct_predictions += 1
+    # Stream both files and predict in chunks, so memory stays bounded however large the test set is
+    with open(test_sql_file, 'r') as sql_f, open(test_lineage_file, 'r') as lineage_f:
+        test_pairs = zip(map(str.strip, sql_f), map(str.strip, lineage_f))
+        while True:
+            chunk = list(islice(test_pairs, 1024))
+            if not chunk:
+                break
+            predicted_lineages = predict_lineage_batch([sql for sql, _ in chunk], models)
+            for predicted_lineage, (_, true_lineage) in zip(predicted_lineages, chunk):
+                if predicted_lineage.strip() == true_lineage:
+                    correct_predictions += 1
+            total_predictions += len(chunk)
 
     accuracy = correct_predictions / total_predictions
     print(f"Model Accuracy: {accuracy:.4f}")
@@ -0,0 +1,37 @@
+import pytest
+import torch
+from transformers import T5Config, T5ForConditionalGeneration
+
+from predict import ensemble_generate
+
+PAD, EOS = 0, 1
+
+def tiny_t5(seed):
+    torch.manual_seed(seed)
+    config = T5Config(vocab_size=50, d_model=32, d_kv=8, d_ff=64, num_layers=2, num_heads=4,
+                      decoder_start_token_id=PAD, pad_token_id=PAD, eos_token_id=EOS)
+    model = T5ForConditionalGeneration(config).eval()
+    # A larger EOS logit makes hypotheses end at different lengths, so finished beams get exercised
+    with torch.no_grad():
+        model.lm_head.weight[EOS] *= 3
+    return model
+
+def up_to_eos(tokens):
+    """Tokens without padding, cut after the first EOS; generate() keeps emitting EOS on finished rows."""
+    tokens = tokens[tokens != PAD].tolist()
+    return tokens[:tokens.index(EOS) + 1] if EOS in tokens else tokens
+
+@pytest.mark.parametrize("seed", range(6))
+@pytest.mark.parametrize("early_stopping", [True, False])
+@pytest.mark.parametrize("budget", [7, 20])
+def test_single_model_ensemble_matches_generate(seed, early_stopping, budget):
+    model = tiny_t5(seed)
+    input_ids = torch.randint(2, 50, (5, 9))
+    attention_mask = torch.ones_like(input_ids)
+    attention_mask[0, 6:] = 0
+    attention_mask[3, 4:] = 0
+    with torch.inference_mode():
+        expected = model.generate(input_ids, attention_mask=attention_mask, num_beams=4, max_new_tokens=budget,
+                                  early_stopping=early_stopping, do_sample=False)
+        actual = ensemble_generate([model], input_ids, attention_mask, budget, early_stopping=early_stopping)
+    assert [up_to_eos(row) for row in actual] == [up_to_eos(row) for row in expected]
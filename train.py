@@ -1,15 +1,26 @@
 import numpy as np
 import os
-from transformers import T5ForConditionalGeneration, Trainer, TrainingArguments
+from transformers import T5Config, T5ForConditionalGeneration, Trainer, TrainingArguments
 from sklearn.model_selection import KFold
 import evaluate
 import torch
+import optuna
 from embed import tokenizer
 import datetime
 import warnings
 import json
 warnings.filterwarnings("ignore")
 
+# T5 activations overflow in float16, so mixed precision is only enabled where bfloat16 is supported
+USE_BF16 = torch.cuda.is_available() and torch.cuda.is_bf16_supported()
+
+# Read the pretrained checkpoint once; every fold of every trial starts from these CPU weights
+BASE_CONFIG = T5Config.from_pretrained('t5-base')
+BASE_STATE_DICT = T5ForConditionalGeneration.from_pretrained('t5-base').state_dict()
+
+# Loaded once; compute_metrics runs after every epoch of every fold and trial
+ROUGE = evaluate.load("rouge")
+
 def compute_metrics(eval_preds):
     preds, labels = eval_preds
     if isinstance(preds, tuple):
@@ -18,17 +29,20 @@ def compute_metrics(eval_preds):
     labels = np.where(labels != -100, labels, tokenizer.pad_token_id)
     decoded_labels = tokenizer.batch_decode(labels, skip_special_tokens=True)
     
-    metric = evaluate.load("rouge")
-    result = metric.compute(predictions=decoded_preds, references=decoded_labels, use_stemmer=True)
+    result = ROUGE.compute(predictions=decoded_preds, references=decoded_labels, use_stemmer=True, use_aggregator=True)
     
     return {
-        'rouge1': result['rouge1'].mid.fmeasure,
-        'rouge2': result['rouge2'].mid.fmeasure,
-        'rougeL': result['rougeL'].mid.fmeasure,
+        'rouge1': result['rouge1'],
+        'rouge2': result['rouge2'],
+        'rougeL': result['rougeL'],
     }
 
 def train(train_dataset, params, data_collator):
-    model = T5ForConditionalGeneration.from_pretrained('t5-base')
+    model = T5ForConditionalGeneration(BASE_CONFIG)
+    # load_state_dict copies into the new model's own parameters, leaving BASE_STATE_DICT untouched
+    model.load_state_dict(BASE_STATE_DICT)
+    # The decoder cache is useless while training with recomputed activations
+    model.config.use_cache = False
     
     training_args = TrainingArguments(
         output_dir='./results',
@@ -41,6 +55,14 @@ def train(train_dataset, params, data_collator):
         evaluation_strategy="epoch",
         save_strategy="epoch",
         load_best_model_at_end=True,
+        # Recompute activations in the backward pass so the larger batch sizes fit in memory
+        gradient_checkpointing=True,
+        gradient_checkpointing_kwargs={"use_reentrant": False},
+        bf16=USE_BF16,
+        tf32=True if USE_BF16 else None,
+        optim="adamw_torch_fused" if torch.cuda.is_available() else "adamw_torch",
+        dataloader_num_workers=4,
+        dataloader_pin_memory=True,
     )
     
     trainer = Trainer(
@@ -52,9 +74,10 @@ def train(train_dataset, params, data_collator):
     )
     
     trainer.train()
+    trainer.model.config.use_cache = True
     return trainer.model
 
-def cross_validation(dataset, params, model_save_path, data_collator, n_splits=5):
+def cross_validation(dataset, params, model_save_path, data_collator, n_splits=5, trial=None):
     kf = KFold(n_splits=n_splits, shuffle=True, random_state=42)
     
     rouge1_list, rouge2_list, rougeL_list = [], [], []
@@ -83,37 +106,37 @@ def cross_validation(dataset, params, model_save_path, data_collator, n_splits=5
         rougeL_list.append(metrics['eval_rougeL'])
         
         print(f"Fold {fold + 1} - ROUGE-1: {metrics['eval_rouge1']:.3f}, ROUGE-2: {metrics['eval_rouge2']:.3f}, ROUGE-L: {metrics['eval_rougeL']:.3f}")
+        
+        if trial is not None:
+            # Report the running mean so far and stop configurations below the median of earlier trials
+            trial.report((np.mean(rouge1_list) + np.mean(rouge2_list) + np.mean(rougeL_list)) / 3, step=fold)
+            if trial.should_prune():
+                raise optuna.TrialPruned()
     
     return np.mean(rouge1_list), np.mean(rouge2_list), np.mean(rougeL_list)
 
-def optimize_hyperparameters(dataset, model_save_path, data_collator):
-    learning_rate_candidates = [1e-5, 3e-5, 5e-5]
-    batch_size_candidates = [4, 8, 16]
-    num_epochs_candidates = [3, 5, 10]
-    weight_decay_candidates = [0.01, 0.1]
-    
-    best_params = None
-    best_rouge = 0
+def optimize_hyperparameters(dataset, model_save_path, data_collator, *, n_trials=20):
+    def objective(trial):
+        params = {
+            'learning_rate': trial.suggest_float('learning_rate', 1e-5, 5e-5, log=True),
+            'batch_size': trial.suggest_categorical('batch_size', [8, 16, 32]),
+            'num_train_epochs': trial.suggest_categorical('num_train_epochs', [3, 5, 10]),
+            'weight_decay': trial.suggest_categorical('weight_decay', [0.01, 0.1]),
+        }
+        
+        rouge1, rouge2, rougeL = cross_validation(dataset, params, model_save_path, data_collator, trial=trial)
+        
+        print(f"Params: {params}")
+        print(f"Results: ROUGE-1={rouge1:.3f}, ROUGE-2={rouge2:.3f}, ROUGE-L={rougeL:.3f}")
+        
+        return (rouge1 + rouge2 + rougeL) / 3
     
-    for lr in learning_rate_candidates:
-        for bs in batch_size_candidates:
-            for epochs in num_epochs_candidates:
-                for wd in weight_decay_candidates:
-                    params = {
-                        'learning_rate': lr,
-                        'batch_size': bs,
-                        'num_train_epochs': epochs,
-                        'weight_decay': wd,
-                    }
-                    
-                    rouge1, rouge2, rougeL = cross_validation(dataset, params, model_save_path, data_collator)
-                    avg_rouge = (rouge1 + rouge2 + rougeL) / 3
-                    
-                    print(f"Params: {params}")
-                    print(f"Results: ROUGE-1={rouge1:.3f}, ROUGE-2={rouge2:.3f}, ROUGE-L={rougeL:.3f}")
-                    
-                    if avg_rouge > best_rouge:
-                        best_rouge = avg_rouge
-                        best_params = params.copy()
+    # TPE proposes configurations from earlier results instead of walking the full grid
+    study = optuna.create_study(
+        direction="maximize",
+        sampler=optuna.samplers.TPESampler(seed=42),
+        pruner=optuna.pruners.MedianPruner(n_warmup_steps=1),
+    )
+    study.optimize(objective, n_trials=n_trials)
     
-    return best_params
+    return study.best_params